@@ -0,0 +1,106 @@
+"""
+Micro-batching queue for query embeddings.
+Coalesces embed requests that arrive within a short window into a single forward pass,
+amortizing tokenizer and ONNX Runtime call overhead under concurrent load.
+
+クエリ埋め込みのためのマイクロバッチキュー。
+短い時間窓内に到着した埋め込みリクエストを1回のフォワードパスにまとめ、
+同時負荷時のトークナイザーおよび ONNX Runtime の呼び出しオーバーヘッドを償却します。
+"""
+
+import asyncio
+import os
+
+import numpy as np
+
+from app.embed import embed_queries
+
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "32"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+
+
+class EmbedQueue:
+    """
+    Background task owning an asyncio.Queue of (text, Future) pairs.
+    (text, Future) のペアを保持する asyncio.Queue を所有するバックグラウンドタスク。
+    """
+
+    def __init__(self, max_batch: int = EMBED_BATCH_MAX, max_wait_ms: float = EMBED_BATCH_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: asyncio.Queue[tuple[str, asyncio.Future]] | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """Start the batching loop on the running event loop. / 実行中のイベントループでバッチ処理ループを開始します。"""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the batching loop and fail any pending requests. / バッチ処理ループを停止し、保留中のリクエストを失敗させます。"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        while not self._queue.empty():
+            _, fut = self._queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(RuntimeError("Embedding queue stopped"))
+        self._task = None
+        self._queue = None
+
+    async def submit(self, text: str) -> np.ndarray:
+        """
+        Embed text via the batching loop (falls back to a direct thread call if not started).
+        Returns a read-only array (float32, or float16 when EMBED_PRECISION=float16).
+        バッチ処理ループ経由でテキストを埋め込みます（未開始の場合はスレッドで直接呼び出します）。
+        読み取り専用の配列（float32、EMBED_PRECISION=float16 の場合は float16）を返します。
+        """
+        if self._queue is None:
+            return (await asyncio.to_thread(embed_queries, [text]))[0]
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, fut))
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                # Take whatever is already queued without a timed wait (no wait_for task per item)
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Drop requests whose callers have gone away (client disconnect cancels the future)
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+
+            texts = [text for text, _ in batch]
+            try:
+                vectors = await asyncio.to_thread(embed_queries, texts)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+
+            for (_, fut), vec in zip(batch, vectors):
+                if not fut.done():
+                    fut.set_result(vec)
+
+
+embed_queue = EmbedQueue()
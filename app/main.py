@@ -1,25 +1,39 @@
 """
 Serverless RAG API - FastAPI application with Azure AI Search integration.
-Uses local sentence-transformers for embedding (no API costs).
+Uses local ONNX Runtime (all-MiniLM-L6-v2) for embedding (no API costs).
 
 サーバーレス RAG API - Azure AI Search と統合された FastAPI アプリケーション。
-ローカルの sentence-transformers を使用して埋め込みを行います（APIコストゼロ）。
+ローカルの ONNX Runtime（all-MiniLM-L6-v2）を使用して埋め込みを行います（APIコストゼロ）。
 """
 
 import os
 import sys
+import copy
+import queue
+import hashlib
+import atexit
+import asyncio
 import logging
+import threading
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from collections.abc import AsyncIterator
 from typing import Any
 
-from pythonjsonlogger import jsonlogger
+import httpx
+import orjson
+import numpy as np
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 from azure.search.documents.models import VectorizedQuery
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
-from app.embed import embed_text, get_dimension
-from app.search_client import get_search_client
+from app.embed import get_cache_info, get_dimension, warmup as warmup_embedding
+from app.embed_queue import embed_queue
+from app.semantic_cache import semantic_cache
+from app.search_client import close_async_search_client, get_async_search_client
 
 
 # ---- Build / version metadata (injected by CI/CD) ----
@@ -32,6 +46,30 @@ OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5-mini")
 OPENAI_MAX_OUTPUT_TOKENS = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "1024"))
 OPENAI_REASONING_EFFORT = os.getenv("OPENAI_REASONING_EFFORT", "medium")
 OPENAI_VERBOSITY = os.getenv("OPENAI_VERBOSITY", "medium")
+OPENAI_TIMEOUT_S = float(os.getenv("OPENAI_TIMEOUT_S", "60"))
+# Brute-force kNN over the whole index instead of HNSW; only worth it for tiny corpora.
+# true / false, or auto: exhaustive only while the index holds fewer than SEARCH_EXHAUSTIVE_MAX_DOCS documents
+SEARCH_EXHAUSTIVE = os.getenv("SEARCH_EXHAUSTIVE", "false").lower()
+SEARCH_EXHAUSTIVE_MAX_DOCS = int(os.getenv("SEARCH_EXHAUSTIVE_MAX_DOCS", "10000"))
+SEARCH_DOC_COUNT_TTL_S = float(os.getenv("SEARCH_DOC_COUNT_TTL_S", "300"))
+# Pin the warmed-up model in RAM (mlockall) so idle replicas don't page the weights out.
+# Requires CAP_IPC_LOCK / a sufficient RLIMIT_MEMLOCK; size the container memory request to cover the whole process.
+EMBED_MLOCK = os.getenv("EMBED_MLOCK", "false").lower() == "true"
+
+# ---- Prompt templates (built once at import, not per request) ----
+SYSTEM_PROMPT = (
+    "你是一个专业的问答助手。只根据提供的上下文信息回答问题，禁止编造。\n"
+    "如果上下文不足以回答，请直接说“我不知道”，或提出一个最关键的追问。\n"
+    "回答要求：先给结论，再给要点；引用来源用编号，如 [1]、[2]。"
+)
+CONTEXT_TEMPLATE = "[{n}] 来源: {source}\n{content}".format
+USER_TEMPLATE = """上下文信息（已编号）：
+{context}
+
+用户问题：{question}
+
+请基于上述上下文信息回答问题。""".format
+NO_CONTEXT_ANSWER = "抱歉，未能检索到相关信息来回答您的问题。"
 
 _REASONING_EFFORT_ALLOWED = {"none", "minimal", "low", "medium", "high", "xhigh"}
 _VERBOSITY_ALLOWED = {"low", "medium", "high"}
@@ -81,23 +119,44 @@ def _safe_get_dd_correlation() -> dict[str, str]:
         return {}
 
 
-class DatadogJsonFormatter(jsonlogger.JsonFormatter):
+# LogRecord attributes that are not user-supplied `extra` fields
+_RESERVED_LOG_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class DatadogJsonFormatter(logging.Formatter):
     """
-    JSON formatter that injects Datadog correlation fields + basic logger metadata.
+    JSON formatter (orjson) that injects Datadog correlation fields + basic logger metadata.
     
-    Datadogの相関フィールドと基本的なロガーメタデータを注入するカスタムJSONフォーマッター。
+    Datadogの相関フィールドと基本的なロガーメタデータを注入するカスタムJSONフォーマッター（orjson）。
     """
 
-    def add_fields(self, log_record: dict[str, Any], record: logging.LogRecord, message_dict: dict[str, Any]) -> None:
-        super().add_fields(log_record, record, message_dict)
+    def format(self, record: logging.LogRecord) -> str:
+        log_record: dict[str, Any] = {
+            "asctime": self.formatTime(record),
+            "levelname": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+        }
+        # Fields passed via logger.info(..., extra={...})
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_LOG_ATTRS and not key.startswith("_"):
+                log_record[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            log_record["exc_info"] = record.exc_text
+        if record.stack_info:
+            log_record["stack_info"] = self.formatStack(record.stack_info)
 
         # Always include stable service metadata (even if not inside a trace)
         log_record.setdefault("dd.service", os.getenv("DD_SERVICE", SERVICE_NAME))
         log_record.setdefault("dd.env", os.getenv("DD_ENV", ENV_NAME))
         log_record.setdefault("dd.version", os.getenv("DD_VERSION", APP_VERSION))
 
-        # Inject correlation fields if available (trace/span + potentially overrides)
-        log_record.update(_safe_get_dd_correlation())
+        # Inject correlation fields if available (trace/span + potentially overrides).
+        # Captured on the logging thread by _DatadogQueueHandler when logging goes through the queue.
+        correlation = getattr(record, "_dd_correlation", None)
+        log_record.update(_safe_get_dd_correlation() if correlation is None else correlation)
 
         # Standard fields
         log_record["logger.name"] = record.name
@@ -108,12 +167,40 @@ class DatadogJsonFormatter(jsonlogger.JsonFormatter):
         log_record["process.pid"] = record.process
         log_record["process.name"] = record.processName
 
+        return orjson.dumps(log_record, default=str).decode()
+
+
+_TRACEBACK_FORMATTER = logging.Formatter()
+
+
+class _DatadogQueueHandler(QueueHandler):
+    """
+    QueueHandler that only captures request-thread state; JSON serialization and I/O
+    happen in the QueueListener's background thread.
+    
+    リクエストスレッドの状態のみを取得する QueueHandler。JSON シリアライズと I/O は
+    QueueListener のバックグラウンドスレッドで行います。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Trace context is thread/task-local, so it must be read before the hand-off
+        record._dd_correlation = _safe_get_dd_correlation()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _TRACEBACK_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
 
 def _configure_logging() -> None:
     """
     Configure JSON logging once, avoid duplicate handlers, and unify uvicorn logs.
+    Records are handed to a QueueListener thread so logger calls never block on stdout.
     
     JSONロギングを一度だけ設定し、ハンドラーの重複を防ぎ、uvicornのログ出力を一元化します。
+    レコードは QueueListener スレッドに渡されるため、ロガー呼び出しが stdout への書き込みでブロックされません。
     """
     root = logging.getLogger()
     root.setLevel(logging.INFO)
@@ -123,12 +210,15 @@ def _configure_logging() -> None:
         if getattr(h, "_is_datadog_json", False):
             return  # already configured
 
-    handler = logging.StreamHandler(stream=sys.stdout)
-    handler._is_datadog_json = True  # type: ignore[attr-defined]
+    stream_handler = logging.StreamHandler(stream=sys.stdout)
+    stream_handler.setFormatter(DatadogJsonFormatter())
 
-    # Keep format minimal; jsonlogger controls fields
-    fmt = "%(asctime)s %(levelname)s %(name)s %(message)s"
-    handler.setFormatter(DatadogJsonFormatter(fmt))
+    handler = _DatadogQueueHandler(queue.SimpleQueue())
+    handler._is_datadog_json = True  # type: ignore[attr-defined]
+    listener = QueueListener(handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Flush remaining records on interpreter shutdown
+    atexit.register(listener.stop)
 
     # Replace handlers to avoid duplicates from uvicorn/gunicorn defaults
     root.handlers = [handler]
@@ -148,33 +238,119 @@ logger = logging.getLogger(__name__)
 load_dotenv(override=True)
 
 
-def get_openai_client() -> OpenAI:
+_OPENAI_CLIENT: AsyncOpenAI | None = None
+_OPENAI_CLIENT_LOCK = threading.Lock()
+
+
+def get_openai_client() -> AsyncOpenAI:
     """
     Lazily initialize OpenAI client so the app can start and /health can respond
     even if OPENAI_API_KEY is missing (useful during infra bring-up).
+    The client is created once and shared so its HTTP keep-alive pool is reused across requests.
     
     OpenAIクライアントを遅延初期化します。これにより、環境変数OPENAI_API_KEYが不足している場合でも、
     アプリケーションの起動と/healthエンドポイントへの応答が可能になります。
+    クライアントは一度だけ作成して共有し、HTTP キープアライブ接続をリクエスト間で再利用します。
+    """
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is None:
+        with _OPENAI_CLIENT_LOCK:
+            if _OPENAI_CLIENT is None:
+                api_key = os.getenv("OPENAI_API_KEY")
+                if not api_key:
+                    raise RuntimeError("OPENAI_API_KEY is not set")
+                # Explicit pool limits: the default httpx pool stalls under high request concurrency.
+                # HTTP/2 multiplexes concurrent calls over a few TLS connections to the API.
+                _OPENAI_CLIENT = AsyncOpenAI(
+                    api_key=api_key,
+                    http_client=DefaultAsyncHttpxClient(
+                        http2=True,
+                        limits=httpx.Limits(
+                            max_connections=500,
+                            max_keepalive_connections=200,
+                            keepalive_expiry=60,
+                        ),
+                        timeout=httpx.Timeout(OPENAI_TIMEOUT_S, connect=5.0),
+                    ),
+                )
+    return _OPENAI_CLIENT
+
+
+async def close_openai_client() -> None:
+    """Close the shared OpenAI client, if created. / 共有の OpenAI クライアントが作成済みであれば閉じます。"""
+    global _OPENAI_CLIENT
+    client, _OPENAI_CLIENT = _OPENAI_CLIENT, None
+    if client is not None:
+        await client.close()
+
+
+def _mlock_process_memory() -> None:
+    """
+    Lock all currently mapped pages (incl. model weights) into RAM via mlockall(MCL_CURRENT).
+    
+    mlockall(MCL_CURRENT) により、現在マップされている全ページ（モデルの重みを含む）を RAM に固定します。
     """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is not set")
-    return OpenAI(api_key=api_key)
+    import ctypes
+
+    MCL_CURRENT = 1
+    libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    if libc.mlockall(MCL_CURRENT) != 0:
+        errno = ctypes.get_errno()
+        logger.warning("mlockall failed", extra={"errno": errno, "error": os.strerror(errno)})
+    else:
+        logger.info("Process memory locked (mlockall)")
+
+
+async def _background_warmup() -> None:
+    """Load the embedding model after the server is listening. / サーバーの待ち受け開始後に埋め込みモデルをロードします。"""
+    try:
+        # The warmup forward pass touches every weight page, so they are resident before locking
+        await asyncio.to_thread(warmup_embedding)
+        logger.info("Embedding model warmed up")
+        if EMBED_MLOCK:
+            await asyncio.to_thread(_mlock_process_memory)
+    except Exception:
+        logger.error("Background embedding warmup failed", exc_info=True)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start/stop background workers with the application.
+    The model warmup is scheduled, not awaited, so /health responds immediately on cold start.
+    
+    アプリケーションの起動・終了に合わせてバックグラウンドワーカーを開始・停止します。
+    モデルのウォームアップは待機せずにスケジュールするため、コールドスタート時も /health が即座に応答します。
+    """
+    await embed_queue.start()
+    warmup_task = asyncio.create_task(_background_warmup())
+    yield
+    warmup_task.cancel()
+    await embed_queue.stop()
+    await close_async_search_client()
+    await close_openai_client()
 
 
 app = FastAPI(
     title="Serverless RAG API",
-    description="RAG API using Azure AI Search with local sentence-transformers embedding (Azure AI Search とローカルの sentence-transformers を使用した RAG API)",
+    description="RAG API using Azure AI Search with local ONNX Runtime embedding (Azure AI Search とローカルの ONNX Runtime 埋め込みを使用した RAG API)",
     version=APP_VERSION,
+    lifespan=lifespan,
+    # Serialize dict-returning endpoints with orjson instead of the stdlib json encoder
+    default_response_class=ORJSONResponse,
 )
 
 
 class QueryRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     question: str = Field(..., min_length=1, description="Question to search for")
     top_k: int = Field(3, ge=1, le=10, description="Number of results to return")
 
 
 class ContextHit(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     id: str
     source: str | None = None
     score: float | None = None
@@ -182,113 +358,209 @@ class ContextHit(BaseModel):
 
 
 class QueryResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     answer: str
     contexts: list[ContextHit]
 
 
+def _static_json(payload: dict[str, Any]) -> tuple[bytes, str]:
+    """Serialize a constant payload once and derive its strong ETag. / 定数ペイロードを一度だけシリアライズし、強い ETag を生成します。"""
+    body = orjson.dumps(payload)
+    return body, '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _conditional_json(request: Request, body: bytes, etag: str, cache_control: str) -> Response:
+    """
+    Return 304 when the client already holds this ETag, else the precomputed JSON body.
+    
+    クライアントが同じ ETag を保持していれば 304 を、そうでなければ事前計算済みの JSON 本文を返します。
+    """
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in (t.strip() for t in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# Build metadata is fixed for the life of the process, so these bodies are serialized once at import
+_ROOT_JSON, _ROOT_ETAG = _static_json({
+    "service": "Serverless RAG API",
+    "version": APP_VERSION,
+    "build_sha": BUILD_SHA,
+    "image_tag": IMAGE_TAG,
+    "env": ENV_NAME,
+    "embedding_model": "all-MiniLM-L6-v2",
+    "embedding_dimension": get_dimension(),
+})
+_HEALTH_JSON, _HEALTH_ETAG = _static_json({
+    "status": "ok",
+    "service": SERVICE_NAME,
+    "version": APP_VERSION,
+    "build_sha": BUILD_SHA,
+    "image_tag": IMAGE_TAG,
+    "env": ENV_NAME,
+})
+
+
 @app.get("/")
-def root():
+async def root(request: Request):
     """Root endpoint with service info. / サービス情報を提供するルートエンドポイント"""
-    return {
-        "service": "Serverless RAG API",
-        "version": APP_VERSION,
-        "build_sha": BUILD_SHA,
-        "image_tag": IMAGE_TAG,
-        "env": ENV_NAME,
-        "embedding_model": "all-MiniLM-L6-v2",
-        "embedding_dimension": get_dimension(),
-    }
+    return _conditional_json(request, _ROOT_JSON, _ROOT_ETAG, "public, max-age=30")
 
 
 @app.get("/health")
-def health():
+async def health(request: Request):
     """Health check endpoint. / ヘルスチェックエンドポイント"""
-    return {
-        "status": "ok",
-        "service": SERVICE_NAME,
-        "version": APP_VERSION,
-        "build_sha": BUILD_SHA,
-        "image_tag": IMAGE_TAG,
-        "env": ENV_NAME,
-    }
+    # Caches must revalidate so a stale 200 never masks a down replica; revalidation is a cheap 304
+    return _conditional_json(request, _HEALTH_JSON, _HEALTH_ETAG, "no-cache")
 
 
 @app.get("/warmup")
-def warmup():
+async def warmup():
     """Warm up the embedding model so the first /query is fast. / 初回の /query 応答を高速化するため、埋め込みモデルをウォームアップします"""
     try:
-        _ = embed_text("warmup")
+        await asyncio.to_thread(warmup_embedding)
         return {"status": "ok", "embedding_dimension": get_dimension()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Warmup failed: {str(e)}")
 
 
-@app.post("/query", response_model=QueryResponse)
-def query(req: QueryRequest):
+@app.get("/cache_stats")
+async def cache_stats():
+    """Embedding and semantic answer cache statistics. / 埋め込みキャッシュとセマンティック回答キャッシュの統計情報"""
+    return {"embedding_cache": get_cache_info(), "semantic_cache": semantic_cache.info()}
+
+
+# ---- OpenAI request invariants (normalized once at import) ----
+_REASONING_EFFORT = _normalize_choice(OPENAI_REASONING_EFFORT, _REASONING_EFFORT_ALLOWED, "medium")
+_VERBOSITY = _normalize_choice(OPENAI_VERBOSITY, _VERBOSITY_ALLOWED, "medium")
+_IS_GPT5 = OPENAI_MODEL.startswith("gpt-5")
+_BASE_OPENAI_REQUEST: dict[str, Any] = {
+    "model": OPENAI_MODEL,
+    "instructions": SYSTEM_PROMPT,
+    "max_output_tokens": OPENAI_MAX_OUTPUT_TOKENS,
+    **({"reasoning": {"effort": _REASONING_EFFORT}, "text": {"verbosity": _VERBOSITY}} if _IS_GPT5 else {}),
+}
+
+
+# Cached (document count, fetched at) for SEARCH_EXHAUSTIVE=auto
+_doc_count_cache: tuple[int, float] | None = None
+
+
+async def _use_exhaustive() -> bool:
     """
-    Query the RAG system using hybrid search (vector + keyword).
+    Decide whether to run brute-force kNN; in auto mode this uses a TTL-cached index document count.
     
-    ハイブリッド検索（ベクトル検索 + キーワード検索）を使用して、RAGシステムにクエリを実行します。
+    総当たり kNN を実行するかを判定します。auto モードでは TTL 付きでキャッシュしたインデックスのドキュメント数を使用します。
     """
-    # 1) Generate query vector using local embedding
-    qvec = embed_text(req.question)
+    global _doc_count_cache
+    if SEARCH_EXHAUSTIVE != "auto":
+        return SEARCH_EXHAUSTIVE == "true"
+    loop = asyncio.get_running_loop()
+    if _doc_count_cache is None or loop.time() - _doc_count_cache[1] > SEARCH_DOC_COUNT_TTL_S:
+        try:
+            count = await get_async_search_client().get_document_count()
+        except Exception:
+            # Fall back to HNSW (the cheap path on large indexes) if the count is unavailable
+            logger.warning("Document count lookup failed", exc_info=True)
+            return False
+        _doc_count_cache = (count, loop.time())
+    return _doc_count_cache[0] < SEARCH_EXHAUSTIVE_MAX_DOCS
+
+
+# Search result keys / 検索結果のキー
+_ID, _SOURCE, _SCORE, _CONTENT = "id", "source", "@search.score", "content"
+
 
-    # 2) Construct vector query for Azure AI Search
+async def _iter_contexts(question: str, qvec: np.ndarray, top_k: int) -> AsyncIterator[ContextHit]:
+    """
+    Run the hybrid search (vector + keyword) and yield each hit as soon as it is parsed.
+    
+    ハイブリッド検索（ベクトル + キーワード）を実行し、各ヒットを解析し次第 yield します。
+    """
+    # Construct vector query for Azure AI Search
+    # The SDK JSON-encodes the vector, so convert the float32 array at this boundary only
     vector_query = VectorizedQuery(
-        vector=qvec,
-        k_nearest_neighbors=req.top_k,
+        vector=qvec.tolist(),
+        k_nearest_neighbors=top_k,
         fields="contentVector",
-        exhaustive=True,
+        exhaustive=await _use_exhaustive(),
     )
 
-    search_client = get_search_client()
+    search_client = get_async_search_client()
+    results = await search_client.search(
+        search_text=question,
+        vector_queries=[vector_query],
+        top=top_k,
+        select=[_ID, _CONTENT, _SOURCE],
+    )
 
-    # 3) Execute hybrid search (Vector + Keyword)
-    try:
-        results = search_client.search(
-            search_text=req.question,
-            vector_queries=[vector_query],
-            top=req.top_k,
-            select=["id", "content", "source", "createdAt"],
+    # Format results (pages are fetched lazily while iterating).
+    # Hits come from our own index, so skip Pydantic validation with model_construct.
+    async for r in results:
+        yield ContextHit.model_construct(
+            id=r[_ID],
+            source=r.get(_SOURCE),
+            score=r.get(_SCORE),
+            content=r.get(_CONTENT),
         )
+
+
+async def _search_contexts(question: str, qvec: np.ndarray, top_k: int) -> list[ContextHit]:
+    """Run the hybrid search and collect all hits. / ハイブリッド検索を実行し、全ヒットを収集します。"""
+    return [ctx async for ctx in _iter_contexts(question, qvec, top_k)]
+
+
+async def _retrieve(req: QueryRequest) -> tuple[np.ndarray, list[ContextHit]]:
+    """
+    Embed the question and run the hybrid search; returns (query vector, contexts).
+    
+    質問を埋め込み、ハイブリッド検索を実行します。(クエリベクトル, コンテキスト) を返します。
+    """
+    # 1) Generate query vector using local embedding (micro-batched with concurrent requests)
+    qvec = await embed_queue.submit(req.question)
+
+    # 2) Execute hybrid search (Vector + Keyword)
+    try:
+        contexts = await _search_contexts(req.question, qvec, req.top_k)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
 
-    # 4) Format results
-    contexts: list[ContextHit] = []
-    for r in results:
-        contexts.append(
-            ContextHit(
-                id=r.get("id"),
-                source=r.get("source"),
-                score=r.get("@search.score"),
-                content=r.get("content"),
-            )
-        )
+    return qvec, contexts
 
-    # 5) Generate answer using OpenAI gpt-5-mini
-    if not contexts:
-        answer = "抱歉，未能检索到相关信息来回答您的问题。"
-    else:
-        context_text = "\n\n".join(
-            [
-                f"[{i + 1}] 来源: {ctx.source or 'unknown'}\n{ctx.content}"
-                for i, ctx in enumerate(contexts)
-            ]
-        )
 
-        system_prompt = (
-            "你是一个专业的问答助手。只根据提供的上下文信息回答问题，禁止编造。\n"
-            "如果上下文不足以回答，请直接说“我不知道”，或提出一个最关键的追问。\n"
-            "回答要求：先给结论，再给要点；引用来源用编号，如 [1]、[2]。"
-        )
+def _user_prompt(question: str, contexts: list[ContextHit]) -> str:
+    """Build the numbered-context user prompt. / 番号付きコンテキストを含むユーザープロンプトを構築します。"""
+    context_text = "\n\n".join(
+        CONTEXT_TEMPLATE(n=i, source=ctx.source or "unknown", content=ctx.content)
+        for i, ctx in enumerate(contexts, 1)
+    )
+    return USER_TEMPLATE(context=context_text, question=question)
 
-        user_prompt = f"""上下文信息（已编号）：
-{context_text}
 
-用户问题：{req.question}
+@app.post("/query", response_model=QueryResponse)
+async def query(req: QueryRequest):
+    """
+    Query the RAG system using hybrid search (vector + keyword).
+    
+    ハイブリッド検索（ベクトル検索 + キーワード検索）を使用して、RAGシステムにクエリを実行します。
+    """
+    qvec, contexts = await _retrieve(req)
 
-请基于上述上下文信息回答问题。"""
+    # 5) Generate answer using OpenAI gpt-5-mini (or reuse a semantically cached one)
+    doc_ids = tuple(ctx.id for ctx in contexts)
+    if not contexts:
+        answer = NO_CONTEXT_ANSWER
+    elif (cached_answer := semantic_cache.lookup(qvec, doc_ids)) is not None:
+        # Near-duplicate question answered from the same evidence: skip the LLM round-trip
+        answer = cached_answer
+        logger.info(
+            "Semantic cache hit",
+            extra={"question": req.question, "context_count": len(contexts)},
+        )
+    else:
+        request = {**_BASE_OPENAI_REQUEST, "input": _user_prompt(req.question, contexts)}
 
         try:
             logger.info(
@@ -297,26 +569,92 @@ def query(req: QueryRequest):
             )
 
             openai_client = get_openai_client()
-            reasoning_effort = _normalize_choice(OPENAI_REASONING_EFFORT, _REASONING_EFFORT_ALLOWED, "medium")
-            verbosity = _normalize_choice(OPENAI_VERBOSITY, _VERBOSITY_ALLOWED, "medium")
-
-            request: dict[str, Any] = {
-                "model": OPENAI_MODEL,
-                "instructions": system_prompt,
-                "input": user_prompt,
-                "max_output_tokens": OPENAI_MAX_OUTPUT_TOKENS,
-            }
-
-            if OPENAI_MODEL.startswith("gpt-5"):
-                request["reasoning"] = {"effort": reasoning_effort}
-                request["text"] = {"verbosity": verbosity}
-
-            resp = openai_client.responses.create(**request)
+            resp = await openai_client.responses.create(**request)
             answer = resp.output_text
 
             logger.info("Successfully generated answer", extra={"output_length": len(answer)})
+            semantic_cache.admit(qvec, doc_ids, answer)
         except Exception as e:
             logger.error("OpenAI API call failed", exc_info=True)
             raise HTTPException(status_code=500, detail=f"OpenAI API call failed: {str(e)}")
 
-    return QueryResponse(answer=answer, contexts=contexts)
+    # Contexts are already typed ContextHit instances: skip re-validation and serialize once in
+    # pydantic-core. Returning a Response bypasses FastAPI's response_model round-trip
+    # (model_dump + validate), while response_model still documents the schema in OpenAPI.
+    response = QueryResponse.model_construct(answer=answer, contexts=contexts)
+    return Response(content=response.model_dump_json(), media_type="application/json")
+
+
+def _sse(event: str, data: Any) -> bytes:
+    """Encode one Server-Sent Event with a JSON payload. / JSON ペイロードを持つ SSE イベントを1件エンコードします。"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+@app.post("/query/stream")
+async def query_stream(req: QueryRequest):
+    """
+    Streaming variant of /query (Server-Sent Events).
+    Emits one `context` event per search hit as it arrives, then `delta` events as answer tokens arrive,
+    then `done` (or `error`). Search runs inside the stream, so the client can render citations before
+    the LLM call starts.
+    
+    /query のストリーミング版（Server-Sent Events）。
+    検索ヒットごとに到着次第 `context` を送信し、回答トークンの到着に合わせて `delta`、最後に `done`（または `error`）を送信します。
+    検索はストリーム内で実行されるため、クライアントは LLM 呼び出しの開始前に引用元を表示できます。
+    """
+    # Embedding errors are raised before streaming starts, so they still map to HTTP 500
+    qvec = await embed_queue.submit(req.question)
+
+    async def events():
+        contexts: list[ContextHit] = []
+        try:
+            async for ctx in _iter_contexts(req.question, qvec, req.top_k):
+                contexts.append(ctx)
+                yield _sse("context", ctx.model_dump())
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            logger.error("Search failed", exc_info=True)
+            yield _sse("error", {"detail": f"Search failed: {str(e)}"})
+            return
+        doc_ids = tuple(ctx.id for ctx in contexts)
+
+        if not contexts:
+            yield _sse("delta", NO_CONTEXT_ANSWER)
+            yield _sse("done", {})
+            return
+
+        cached_answer = semantic_cache.lookup(qvec, doc_ids)
+        if cached_answer is not None:
+            logger.info(
+                "Semantic cache hit",
+                extra={"question": req.question, "context_count": len(contexts)},
+            )
+            yield _sse("delta", cached_answer)
+            yield _sse("done", {})
+            return
+
+        request = {**_BASE_OPENAI_REQUEST, "input": _user_prompt(req.question, contexts)}
+        parts: list[str] = []
+        try:
+            logger.info(
+                "Streaming answer from OpenAI",
+                extra={"question": req.question, "context_count": len(contexts)},
+            )
+            openai_client = get_openai_client()
+            async with openai_client.responses.stream(**request) as stream:
+                async for event in stream:
+                    if event.type == "response.output_text.delta":
+                        parts.append(event.delta)
+                        yield _sse("delta", event.delta)
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            logger.error("OpenAI streaming call failed", exc_info=True)
+            yield _sse("error", {"detail": f"OpenAI API call failed: {str(e)}"})
+            return
+
+        answer = "".join(parts)
+        logger.info("Successfully streamed answer", extra={"output_length": len(answer)})
+        semantic_cache.admit(qvec, doc_ids, answer)
+        yield _sse("done", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
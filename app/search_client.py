@@ -7,14 +7,19 @@ Azure OpenAI への依存関係のない簡易バージョンです。
 """
 
 import os
+import functools
+import threading
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 
 
+@functools.lru_cache(maxsize=1)
 def get_search_client() -> SearchClient:
     """
-    Create and return an Azure AI Search client.
-    Azure AI Search クライアントを作成して返します。
+    Return the shared Azure AI Search client, creating it on first use.
+    SearchClient is thread-safe, so one instance (and its connection pool) is reused by all callers.
+    共有の Azure AI Search クライアントを返します。初回使用時に作成します。
     
     Required environment variables (必須環境変数):
     - AZURE_SEARCH_ENDPOINT: Azure Search service endpoint
@@ -33,3 +38,43 @@ def get_search_client() -> SearchClient:
         index_name=index_name,
         credential=AzureKeyCredential(api_key)
     )
+
+
+_ASYNC_CLIENT: AsyncSearchClient | None = None
+_ASYNC_CLIENT_LOCK = threading.Lock()
+
+
+def get_async_search_client() -> AsyncSearchClient:
+    """
+    Return the shared async Azure AI Search client (aiohttp transport), creating it on first use.
+    Reusing one client keeps the azure-core pipeline and its keep-alive connection pool across requests.
+    共有の非同期 Azure AI Search クライアント（aiohttp トランスポート）を返します。初回使用時に作成します。
+
+    Uses the same environment variables as get_search_client().
+    get_search_client() と同じ環境変数を使用します。
+
+    Returns:
+        Configured async SearchClient instance (設定済みの非同期 SearchClient インスタンス)
+    """
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None:
+        with _ASYNC_CLIENT_LOCK:
+            if _ASYNC_CLIENT is None:
+                endpoint = os.environ["AZURE_SEARCH_ENDPOINT"]
+                index_name = os.environ["AZURE_SEARCH_INDEX_NAME"]
+                api_key = os.environ["AZURE_SEARCH_API_KEY"]
+
+                _ASYNC_CLIENT = AsyncSearchClient(
+                    endpoint=endpoint,
+                    index_name=index_name,
+                    credential=AzureKeyCredential(api_key)
+                )
+    return _ASYNC_CLIENT
+
+
+async def close_async_search_client() -> None:
+    """Close the shared async client, if created. / 共有の非同期クライアントが作成済みであれば閉じます。"""
+    global _ASYNC_CLIENT
+    client, _ASYNC_CLIENT = _ASYNC_CLIENT, None
+    if client is not None:
+        await client.close()
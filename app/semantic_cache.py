@@ -0,0 +1,111 @@
+"""
+Semantic answer cache keyed by query embedding.
+Returns a previously generated answer when a new question is a near-duplicate of a cached one
+AND retrieval returned exactly the same evidence in the same order, skipping the LLM round-trip.
+
+クエリ埋め込みをキーとするセマンティック回答キャッシュ。
+新しい質問がキャッシュ済みの質問とほぼ同一で、かつ検索された根拠が同じ順序で完全に一致する場合に、
+以前生成した回答を返して LLM の呼び出しを省略します。
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from app.embed import get_dimension
+
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+# Cosine similarity gate between query vectors / クエリベクトル間のコサイン類似度の閾値
+SEMANTIC_CACHE_MIN_SIMILARITY = float(os.getenv("SEMANTIC_CACHE_MIN_SIMILARITY", "0.97"))
+
+
+class SemanticCache:
+    """
+    In-process cache of (query vector, ordered retrieved doc ids, answer) with LRU eviction.
+    Answers cite contexts by position, so a hit requires the exact same id sequence: a different
+    top_k or a reordered ranking would otherwise return citations that point at the wrong context.
+    Stored as parallel arrays preallocated to capacity: a contiguous float32 key matrix and a
+    last-used timestamp vector. Query vectors are L2-normalized, so cosine similarity is a single
+    matrix-vector product, and picking the LRU victim is a single argmin.
+
+    (クエリベクトル, 検索されたドキュメントIDの順序付きタプル, 回答) のプロセス内キャッシュ（LRU 方式で削除）。
+    回答はコンテキストを位置で引用するため、ヒットには同一のID列が必要です（top_k や順位が異なると引用先がずれるため）。
+    容量分を事前確保した並列配列（連続した float32 のキー行列と最終使用時刻ベクトル）で保持します。
+    クエリベクトルは L2 正規化済みのため、コサイン類似度は行列ベクトル積1回、LRU の削除対象の選択は argmin 1回で求まります。
+    """
+
+    def __init__(
+        self,
+        capacity: int = SEMANTIC_CACHE_SIZE,
+        min_similarity: float = SEMANTIC_CACHE_MIN_SIMILARITY,
+    ):
+        self.capacity = capacity
+        self.min_similarity = min_similarity
+        slots = max(capacity, 0)
+        self._keys = np.zeros((slots, get_dimension()), dtype=np.float32)
+        self._last_used = np.zeros(slots, dtype=np.float64)
+        # Reused similarity buffer: lookups write scores in place instead of allocating per call
+        self._scores = np.empty(slots, dtype=np.float32)
+        self._doc_ids: list[tuple[str, ...] | None] = [None] * slots
+        self._answers: list[str | None] = [None] * slots
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _match(self, qvec: np.ndarray, doc_ids: tuple[str, ...]) -> int | None:
+        # Caller holds the lock. Every row above the similarity gate is a candidate, not just the argmax:
+        # the same question may be cached under several evidence sets (different top_k, re-ingested docs).
+        if not self._size:
+            return None
+        sims = np.matmul(self._keys[: self._size], qvec.astype(np.float32, copy=False), out=self._scores[: self._size])
+        best = None
+        for slot in np.flatnonzero(sims >= self.min_similarity):
+            # Doc ids are content hashes, so this gate also invalidates answers built on changed evidence
+            if self._doc_ids[slot] == doc_ids and (best is None or sims[slot] > sims[best]):
+                best = int(slot)
+        return best
+
+    def lookup(self, qvec: np.ndarray, doc_ids: tuple[str, ...]) -> str | None:
+        """
+        Return the cached answer for a near-duplicate query retrieved with exactly doc_ids, else None.
+        doc_ids と完全に同じ根拠で検索されたほぼ同一のクエリに対するキャッシュ済み回答を返します。該当しない場合は None。
+        """
+        if self.capacity <= 0:
+            return None
+        with self._lock:
+            slot = self._match(qvec, doc_ids)
+            if slot is None:
+                return None
+            self._last_used[slot] = time.monotonic()
+            return self._answers[slot]
+
+    def admit(self, qvec: np.ndarray, doc_ids: tuple[str, ...], answer: str) -> None:
+        """
+        Store a generated answer, replacing a near-duplicate entry with the same doc_ids or else
+        evicting the least recently used entry when full.
+        生成した回答を保存します。同じ doc_ids を持つほぼ同一のエントリがあれば置き換え、なければ満杯時に LRU のエントリを削除します。
+        """
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            # Refresh the matching row in place so repeated misses on one question can't fill the cache
+            slot = self._match(qvec, doc_ids)
+            if slot is None:
+                if self._size < self.capacity:
+                    slot = self._size
+                    self._size += 1
+                else:
+                    # Overwrite the LRU row in place: no array reallocation or row shifting
+                    slot = int(self._last_used.argmin())
+            self._keys[slot] = qvec
+            self._last_used[slot] = time.monotonic()
+            self._doc_ids[slot] = doc_ids
+            self._answers[slot] = answer
+
+    def info(self) -> dict[str, int]:
+        with self._lock:
+            return {"maxsize": self.capacity, "currsize": self._size}
+
+
+semantic_cache = SemanticCache()
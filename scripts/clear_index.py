@@ -8,11 +8,14 @@ Azure AI Search インデックスからすべてのドキュメントをクリ
 
 import os
 import sys
+import asyncio
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from dotenv import load_dotenv
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 load_dotenv(override=True)
 
@@ -20,36 +23,55 @@ endpoint = os.environ["AZURE_SEARCH_ENDPOINT"]
 index_name = os.environ["AZURE_SEARCH_INDEX_NAME"]
 api_key = os.environ["AZURE_SEARCH_API_KEY"]
 
+# Azure AI Search accepts at most 1000 actions per indexing request
+DELETE_BATCH_SIZE = 1000
+# Max delete requests in flight at once
+DELETE_CONCURRENCY = 16
 
-def clear_index():
+
+@retry(
+    retry=retry_if_exception_type(HttpResponseError),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+async def _delete_batch(client: SearchClient, batch: list[dict]) -> None:
+    """Delete one batch, retrying with exponential backoff. / 指数バックオフで再試行しながら1バッチを削除します。"""
+    await client.delete_documents(documents=batch)
+
+
+async def clear_index():
     """Delete all documents from the index. / インデックスからすべてのドキュメントを削除します。"""
-    client = SearchClient(
+    async with SearchClient(
         endpoint=endpoint,
         index_name=index_name,
         credential=AzureKeyCredential(api_key)
-    )
-    
-    print(f"Clearing all documents from index '{index_name}'...")
-    
-    # Get all document IDs
-    results = client.search(search_text="*", select=["id"], top=1000)
-    doc_ids = [{"id": doc["id"]} for doc in results]
-    
-    if not doc_ids:
-        print("⚠️ Index is already empty.")
-        return
-    
-    print(f"Found {len(doc_ids)} documents to delete...")
-    
-    # Delete in batches
-    batch_size = 100
-    for i in range(0, len(doc_ids), batch_size):
-        batch = doc_ids[i:i+batch_size]
-        client.delete_documents(documents=batch)
-        print(f"  Deleted batch {i//batch_size + 1} ({len(batch)} docs)")
+    ) as client:
+        print(f"Clearing all documents from index '{index_name}'...")
+        
+        # Get all document IDs (the async iterator follows continuation pages, so no 1000-doc cap)
+        results = await client.search(search_text="*", select=["id"])
+        doc_ids = [{"id": doc["id"]} async for doc in results]
+        
+        if not doc_ids:
+            print("⚠️ Index is already empty.")
+            return
+        
+        print(f"Found {len(doc_ids)} documents to delete...")
+        
+        # Delete in concurrent batches
+        batches = [doc_ids[i:i + DELETE_BATCH_SIZE] for i in range(0, len(doc_ids), DELETE_BATCH_SIZE)]
+        semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+        
+        async def _delete(n: int, batch: list[dict]) -> None:
+            async with semaphore:
+                await _delete_batch(client, batch)
+            print(f"  Deleted batch {n} ({len(batch)} docs)")
+        
+        await asyncio.gather(*(_delete(n, b) for n, b in enumerate(batches, 1)))
     
     print("✅ Index cleared successfully!")
 
 
 if __name__ == "__main__":
-    clear_index()
+    asyncio.run(clear_index())
@@ -1,9 +1,9 @@
 """
 Script to create Azure AI Search index with vector search support.
-Uses 384-dimensional vectors (matching sentence-transformers all-MiniLM-L6-v2).
+Uses 384-dimensional vectors (or EMBED_DIM) matching the all-MiniLM-L6-v2 ONNX Runtime embeddings in app.embed.
 
 ベクトル検索をサポートする Azure AI Search インデックスを作成するスクリプト。
-384次元のベクトルを使用します（sentence-transformers all-MiniLM-L6-v2 と一致）。
+384次元（または EMBED_DIM）のベクトルを使用します（app.embed の ONNX Runtime による all-MiniLM-L6-v2 埋め込みと一致）。
 """
 
 import os
@@ -19,7 +19,7 @@ from azure.search.documents.indexes.models import (
     SearchableField, SimpleField, VectorSearch,
     VectorSearchProfile, HnswAlgorithmConfiguration
 )
-from app.embed import get_dimension
+from app.embed import get_dimension, get_precision
 
 load_dotenv(override=True)
 
@@ -34,7 +34,10 @@ def create_index():
         endpoint=endpoint,
         credential=AzureKeyCredential(api_key)
     )
-    dim = get_dimension()  # 384 for all-MiniLM-L6-v2
+    dim = get_dimension()  # 384 for all-MiniLM-L6-v2 (or EMBED_DIM if truncated)
+    # Edm.Half halves vector storage and HNSW memory; must match EMBED_PRECISION used at ingest/query time.
+    # The SDK has no SearchFieldDataType.Half member, so the EDM name is passed as a literal.
+    vector_type = "Edm.Half" if get_precision() == "float16" else SearchFieldDataType.Single
 
     # Define fields
     fields = [
@@ -50,15 +53,17 @@ def create_index():
         ),
         SearchField(
             name="contentVector",
-            type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+            type=SearchFieldDataType.Collection(vector_type),
             searchable=True,
-            vector_search_dimensions=dim,  # Must be 384
+            vector_search_dimensions=dim,  # Must match get_dimension()
             vector_search_profile_name="my-vector-profile"
         ),
-        SearchableField(
+        # Metadata only (returned and filtered on, never full-text searched): no analyzer / inverted index
+        SimpleField(
             name="source",
             type=SearchFieldDataType.String,
-            filterable=True
+            filterable=True,
+            facetable=True
         ),
         SimpleField(
             name="createdAt",
@@ -88,7 +93,7 @@ def create_index():
         vector_search=vector_search
     )
 
-    print(f"Creating index '{index_name}' with dimension {dim}...")
+    print(f"Creating index '{index_name}' with dimension {dim} ({get_precision()})...")
     client.create_or_update_index(index)
     print("✅ Index created successfully!")
 
@@ -8,16 +8,24 @@ data/ ディレクトリからファイルを読み込み、チャンク化し
 
 import os
 import sys
-import glob
-from uuid import uuid4
+import asyncio
+import sqlite3
+import hashlib
+from array import array
+from collections.abc import Iterator
+from itertools import islice
 from datetime import datetime
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from dotenv import load_dotenv
 from pypdf import PdfReader
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from app.embed import embed_text
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import IndexingResult
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from app import embed
+from app.embed import embed_batch, split_by_tokens
 
 load_dotenv(override=True)
 
@@ -29,44 +37,236 @@ api_key = os.environ["AZURE_SEARCH_API_KEY"]
 def read_pdf(path: str) -> str:
     """Extract text from PDF file. / PDF ファイルからテキストを抽出します。"""
     reader = PdfReader(path)
-    text = ""
-    for page in reader.pages:
-        page_text = page.extract_text()
-        if page_text:
-            text += page_text + "\n"
-    return text
+    # Join once instead of growing a string page by page
+    return "".join(page_text + "\n" for page in reader.pages if (page_text := page.extract_text()))
 
 
-def chunk_text(text: str, size: int = 500) -> list[str]:
+# Local content-addressed embedding cache (SQLite); survives index re-creation. Empty string disables it.
+EMBED_CACHE_PATH = os.getenv(
+    "INGEST_EMBED_CACHE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "ingest_embeddings.sqlite"),
+)
+# Everything that changes the vector for a given text; part of every cache key
+_EMBED_FINGERPRINT = "|".join(map(str, (
+    embed.EMBED_MODEL_ID, embed.EMBED_MODEL_DIR, embed.EMBED_ONNX_FILE, embed.EMBED_QUANTIZE,
+    embed.EMBED_MAX_LENGTH, embed.EMBED_DIM, embed.EMBED_PRECISION,
+)))
+
+# File types picked up from data/
+INGEST_EXTENSIONS = (".pdf", ".md", ".txt")
+
+# Chunk size in model tokens (default: one full forward pass) and overlap between consecutive chunks
+INGEST_CHUNK_TOKENS = int(os.getenv("INGEST_CHUNK_TOKENS", str(embed.EMBED_MAX_LENGTH - 2)))
+INGEST_CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "32"))
+
+# Azure AI Search accepts at most 1000 actions per indexing request
+UPLOAD_BATCH_SIZE = 1000
+# Max indexing requests in flight at once
+UPLOAD_CONCURRENCY = 8
+
+
+def chunk_text(text: str) -> Iterator[str]:
     """
-    Split text into chunks of specified size.
-    For production, use LangChain's RecursiveCharacterTextSplitter.
+    Split text into overlapping windows measured in embedding-model tokens (lazily).
+    Character-sized chunks could exceed the encoder's EMBED_MAX_LENGTH tokens and lose their tail.
     
-    テキストを指定されたサイズのチャンクに分割します。
-    本番環境では、LangChain の RecursiveCharacterTextSplitter を使用することをお勧めします。
+    テキストを埋め込みモデルのトークン数で測った重なりのあるウィンドウに（遅延評価で）分割します。
+    文字数ベースのチャンクはエンコーダーの EMBED_MAX_LENGTH トークンを超え、末尾が失われる可能性があります。
     """
-    return [text[i:i+size] for i in range(0, len(text), size)]
+    return split_by_tokens(text, INGEST_CHUNK_TOKENS, INGEST_CHUNK_OVERLAP)
 
 
-def main():
-    """Main ingestion workflow. / メインの取り込みワークフロー。"""
-    client = SearchClient(
+def chunk_id(source: str, chunk: str) -> str:
+    """
+    Deterministic document key from the source filename and chunk text.
+    Re-ingesting unchanged content yields the same keys, so uploads are idempotent upserts.
+    
+    ソースファイル名とチャンク本文から決定的なドキュメントキーを生成します。
+    変更のないコンテンツを再取り込みしても同じキーになるため、アップロードは冪等なアップサートになります。
+    """
+    return hashlib.blake2b(f"{source}:{chunk}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def fetch_existing_ids(client: SearchClient) -> set[str]:
+    """Return the keys of all documents already in the index. / インデックスに既に存在する全ドキュメントのキーを返します。"""
+    results = await client.search(search_text="*", select=["id"])
+    return {doc["id"] async for doc in results}
+
+
+class EmbeddingCache:
+    """
+    SQLite table of blake2b(model fingerprint + text) -> float32 vector bytes.
+    Lets re-runs against a re-created index skip the forward pass for text that was embedded before.
+    
+    blake2b(モデルの識別情報 + テキスト) -> float32 ベクトルのバイト列を保持する SQLite テーブル。
+    インデックスを再作成した後の再実行でも、埋め込み済みのテキストはフォワードパスを省略できます。
+    """
+
+    # Stay well under SQLite's bound-parameter limit
+    _SELECT_CHUNK = 500
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Used from asyncio.to_thread workers, one call at a time
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+        self._prefix = hashlib.blake2b(_EMBED_FINGERPRINT.encode("utf-8") + b"\0", digest_size=16)
+
+    def _key(self, text: str) -> bytes:
+        h = self._prefix.copy()
+        h.update(text.encode("utf-8"))
+        return h.digest()
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """Return vectors for texts, embedding (and storing) only the cache misses. / キャッシュミスのみ埋め込みます。"""
+        keys = [self._key(t) for t in texts]
+        found: dict[bytes, list[float]] = {}
+        for i in range(0, len(keys), self._SELECT_CHUNK):
+            part = keys[i:i + self._SELECT_CHUNK]
+            rows = self._db.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+            )
+            found.update((key, array("f", vec).tolist()) for key, vec in rows)
+
+        misses = [i for i, key in enumerate(keys) if key not in found]
+        if misses:
+            vectors = embed_batch([texts[i] for i in misses])
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                    [(keys[i], array("f", vec).tobytes()) for i, vec in zip(misses, vectors)],
+                )
+            found.update((keys[i], vec) for i, vec in zip(misses, vectors))
+        return [found[key] for key in keys]
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def _is_throttled(exc: BaseException) -> bool:
+    return isinstance(exc, HttpResponseError) and exc.status_code in (429, 503)
+
+
+@retry(
+    retry=retry_if_exception(_is_throttled),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _upload_batch(client: SearchClient, batch: list[dict]) -> list[IndexingResult]:
+    """Upload one batch, retrying with exponential backoff when throttled (429/503). / スロットリング時は指数バックオフで再試行します。"""
+    return await client.upload_documents(documents=batch)
+
+
+async def embed_and_upload(
+    client: SearchClient,
+    chunks: dict[str, tuple[str, str]],
+    created_at: str,
+    cache: EmbeddingCache | None = None,
+) -> int:
+    """
+    Embed {id: (content, source)} chunks and upload them, one UPLOAD_BATCH_SIZE slice at a time.
+    Uploads run in the background while the next slice is embedded, so wall-clock time is roughly
+    max(embed, upload) instead of their sum. Index records exist only for slices in flight, so peak
+    memory does not grow with the corpus. Returns the number of documents that were not indexed;
+    a batch can partially succeed (HTTP 207), so per-document results are checked as well.
+    
+    {id: (content, source)} のチャンクを UPLOAD_BATCH_SIZE 単位で埋め込み、アップロードします。
+    次のスライスを埋め込んでいる間にアップロードをバックグラウンドで実行するため、所要時間は合計ではなく概ね max(埋め込み, アップロード) になります。
+    インデックス用レコードは処理中のスライス分だけ存在するため、ピークメモリはコーパスの大きさに比例して増えません。
+    インデックスに登録されなかったドキュメント数を返します（バッチは部分的に成功する場合があるため、ドキュメントごとの結果も確認します）。
+    """
+    n_batches = -(-len(chunks) // UPLOAD_BATCH_SIZE)
+    # Backpressure: the embedder waits when UPLOAD_CONCURRENCY batches are already queued or in flight
+    slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    tasks: list[asyncio.Task] = []
+    items = iter(chunks.items())
+
+    async def _upload(n: int, batch: list[dict]) -> int:
+        try:
+            results = await _upload_batch(client, batch)
+        except Exception as e:
+            print(f"  ❌ Batch {n}/{n_batches} failed: {type(e).__name__}: {e}")
+            return len(batch)
+        finally:
+            slots.release()
+        rejected = [r for r in results if not r.succeeded]
+        if rejected:
+            first = rejected[0]
+            print(
+                f"  ❌ Batch {n}/{n_batches}: {len(rejected)} document(s) rejected "
+                f"(e.g. {first.key}: {first.status_code} {first.error_message})"
+            )
+        return len(rejected)
+
+    n = 0
+    while part := list(islice(items, UPLOAD_BATCH_SIZE)):
+        n += 1
+        # Embedding is CPU-bound: run it off the event loop so in-flight uploads keep progressing
+        vectors = await asyncio.to_thread(cache.embed if cache else embed_batch, [content for _, (content, _) in part])
+        batch = [
+            {
+                "id": doc_id,
+                "content": content,
+                "contentVector": vector,
+                "source": source,
+                "createdAt": created_at
+            }
+            for (doc_id, (content, source)), vector in zip(part, vectors)
+        ]
+        await slots.acquire()
+        tasks.append(asyncio.create_task(_upload(n, batch)))
+        print(f"  Embedded batch {n}/{n_batches} ({len(batch)} chunks), uploading...")
+
+    failed = await asyncio.gather(*tasks)
+    return sum(failed)
+
+
+async def ingest(chunks: dict[str, tuple[str, str]], cache: EmbeddingCache | None) -> int | None:
+    """
+    Sync new chunks into the index over one SearchClient (one connection pool for listing and uploads).
+    Returns the number of documents not indexed, or None when the index is already up to date.
+    
+    1つの SearchClient（一覧取得とアップロードで共有する接続プール）で新しいチャンクをインデックスに反映します。
+    インデックスに登録されなかったドキュメント数を返します。インデックスが最新の場合は None を返します。
+    """
+    async with SearchClient(
         endpoint=endpoint,
         index_name=index_name,
         credential=AzureKeyCredential(api_key)
-    )
-    
+    ) as client:
+        # Skip chunks already indexed: same key means same source and text, so no re-embed or re-upload
+        total = len(chunks)
+        for doc_id in await fetch_existing_ids(client):
+            chunks.pop(doc_id, None)
+        skipped = total - len(chunks)
+        if skipped:
+            print(f"Skipping {skipped} chunks already in the index")
+        if not chunks:
+            return None
+
+        # Embed in batched forward passes, uploading each finished slice while the next one embeds
+        print(f"\nEmbedding and uploading {len(chunks)} chunks...")
+        return await embed_and_upload(client, chunks, datetime.now().isoformat(), cache)
+
+
+def main():
+    """Main ingestion workflow. / メインの取り込みワークフロー。"""
     # Get data directory path (relative to project root)
     project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     data_dir = os.path.join(project_root, "data")
     
-    # Scan data directory
-    pdf_files = glob.glob(os.path.join(data_dir, "*.pdf"))
-    md_files = glob.glob(os.path.join(data_dir, "*.md"))
-    txt_files = glob.glob(os.path.join(data_dir, "*.txt"))
-    files = pdf_files + md_files + txt_files
+    # Scan data directory in one pass; DirEntry.is_file() uses the cached d_type (no extra stat per entry)
+    files: list[str] = []
+    if os.path.isdir(data_dir):
+        with os.scandir(data_dir) as entries:
+            files = sorted(
+                entry.path for entry in entries
+                if entry.name.endswith(INGEST_EXTENSIONS) and entry.is_file(follow_symlinks=False)
+            )
     
-    docs_to_upload = []
+    # Collect all chunks first so they can be embedded in large batches (keyed by content hash, deduped)
+    chunks_by_id: dict[str, tuple[str, str]] = {}
     
     print(f"Found {len(files)} files in {data_dir}")
     
@@ -78,33 +278,37 @@ def main():
         if file_path.endswith(".pdf"):
             content = read_pdf(file_path)
         else:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            # One raw read + one decode (no TextIOWrapper); keep text mode's newline normalization
+            # so chunk boundaries and content-hash ids stay the same
+            with open(file_path, 'rb') as f:
+                content = f.read().decode('utf-8', errors='replace')
+            if "\r" in content:
+                content = content.replace("\r\n", "\n").replace("\r", "\n")
         
         # Chunk the content
-        chunks = chunk_text(content)
-        
-        for i, chunk in enumerate(chunks):
+        for chunk in chunk_text(content):
             if not chunk.strip():
                 continue
-            
-            doc = {
-                "id": str(uuid4()),  # Generate unique ID
-                "content": chunk,
-                "contentVector": embed_text(chunk),
-                "source": filename,
-                "createdAt": datetime.now().isoformat()
-            }
-            docs_to_upload.append(doc)
+            chunks_by_id.setdefault(chunk_id(filename, chunk), (chunk, filename))
     
-    if docs_to_upload:
-        print(f"\nUploading {len(docs_to_upload)} chunks...")
-        # Batch upload
-        client.upload_documents(documents=docs_to_upload)
-        print("✅ Ingestion complete!")
-    else:
+    if not chunks_by_id:
         print("⚠️ No documents to upload.")
         print(f"   Please add PDF/MD/TXT files to: {data_dir}")
+        return
+    
+    cache = EmbeddingCache(EMBED_CACHE_PATH) if EMBED_CACHE_PATH else None
+    try:
+        failed = asyncio.run(ingest(chunks_by_id, cache))
+    finally:
+        if cache:
+            cache.close()
+    if failed is None:
+        print("✅ Index is already up to date.")
+        return
+    if failed:
+        print(f"⚠️ Ingestion finished with {failed} document(s) not indexed.")
+        sys.exit(1)
+    print("✅ Ingestion complete!")
 
 
 if __name__ == "__main__":
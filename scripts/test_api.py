@@ -2,15 +2,20 @@
 """
 Test script for Azure Container Apps deployed RAG API.
 Requires AZURE_ACCESS_TOKEN environment variable to be set for authenticated endpoints.
+Questions can be passed as arguments; all probes run concurrently over one HTTP/2 connection.
 
 Azure Container Apps にデプロイされた RAG API のテストスクリプト。
 認証付きエンドポイントには AZURE_ACCESS_TOKEN 環境変数が必要です。
+質問は引数で指定でき、すべてのプローブを1本の HTTP/2 接続上で並行実行します。
 """
 
 import os
 import sys
-import json
-import requests
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+import httpx
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -20,13 +25,12 @@ API_URL = os.getenv("API_URL")
 # Reasonable timeouts to avoid hanging forever
 HEALTH_TIMEOUT_SECS = 10
 QUERY_TIMEOUT_SECS = 30
-
-
-def _get_token() -> str | None:
-    token = os.getenv("AZURE_ACCESS_TOKEN")
-    if token:
-        token = token.strip()
-    return token or None
+# Max body bytes shown for non-JSON responses
+DEBUG_BODY_LIMIT = 2000
+# 503s (e.g. a scaled-to-zero replica still starting) are retried with backoff on GET only
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_SECS = 0.5
+DEFAULT_QUESTION = "什么是 RAG？"
 
 
 def _auth_headers(token: str | None) -> dict:
@@ -39,87 +43,126 @@ def _auth_headers(token: str | None) -> dict:
     return headers
 
 
-def _print_response_debug(resp: requests.Response) -> None:
-    """Print helpful debug info without assuming JSON. / JSONを前提としないデバッグ情報を出力"""
-    print(f"Status Code: {resp.status_code}")
+# Read the token and build the headers once; every probe reuses them
+TOKEN = (os.getenv("AZURE_ACCESS_TOKEN") or "").strip() or None
+HEADERS = _auth_headers(TOKEN)
+
+
+async def _read_prefix(resp: httpx.Response, limit: int) -> bytes:
+    """Read at most limit + 1 bytes of a streamed body, then stop. / ストリーミング本文を最大 limit + 1 バイトだけ読み取ります。"""
+    buf = bytearray()
+    async for chunk in resp.aiter_bytes():
+        buf += chunk
+        if len(buf) > limit:
+            break
+    return bytes(buf[:limit + 1])
+
+
+async def _response_debug(resp: httpx.Response) -> str:
+    """Format helpful debug info without assuming JSON. / JSONを前提としないデバッグ情報を整形"""
     ct = resp.headers.get("content-type", "")
-    print(f"Content-Type: {ct}")
+    lines = [f"Status Code: {resp.status_code}", f"Content-Type: {ct}"]
 
     # Try JSON only when it really looks like JSON
     if "application/json" in ct.lower():
         try:
-            print(json.dumps(resp.json(), ensure_ascii=False, indent=2))
-            return
+            lines.append(orjson.dumps(orjson.loads(await resp.aread()), option=orjson.OPT_INDENT_2).decode())
+            return "\n".join(lines)
         except Exception as e:
-            print(f"(JSON parse failed: {type(e).__name__}: {e})")
-
-    # Fallback: print text (truncate if huge)
-    text = resp.text or ""
-    if len(text) > 2000:
-        text = text[:2000] + "\n... (truncated)"
-    print(text if text else "(empty body)")
-
-
-def test_health() -> bool:
+            lines.append(f"(JSON parse failed: {type(e).__name__}: {e})")
+
+    # Fallback: print text, reading only the part that is shown (the rest of a huge body is never downloaded)
+    head = resp.content[:DEBUG_BODY_LIMIT + 1] if resp.is_stream_consumed else await _read_prefix(resp, DEBUG_BODY_LIMIT)
+    text = head[:DEBUG_BODY_LIMIT].decode(resp.encoding or "utf-8", errors="replace")
+    if len(head) > DEBUG_BODY_LIMIT:
+        text += "\n... (truncated)"
+    lines.append(text if text else "(empty body)")
+    return "\n".join(lines)
+
+
+@asynccontextmanager
+async def _stream_with_retry(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+    """
+    Open a streamed request; GET requests are retried on 503 with exponential backoff.
+    ストリーミングリクエストを開きます。GET は 503 の場合に指数バックオフで再試行します。
+    """
+    attempts = RETRY_ATTEMPTS + 1 if method == "GET" else 1
+    for attempt in range(attempts):
+        async with client.stream(method, url, **kwargs) as resp:
+            if resp.status_code != 503 or attempt == attempts - 1:
+                yield resp
+                return
+        await asyncio.sleep(RETRY_BACKOFF_SECS * 2 ** attempt)
+
+
+async def test_health(client: httpx.AsyncClient) -> bool:
     """Test the health endpoint. / ヘルスエンドポイントのテスト"""
-    token = _get_token()
-    headers = _auth_headers(token)
-
-    print("\n🏥 GET /health")
-    print("-" * 50)
+    # Output is printed in one block per probe so concurrent probes don't interleave
+    out = ["\n🏥 GET /health", "-" * 50]
 
     try:
-        resp = requests.get(f"{API_URL}/health", headers=headers, timeout=HEALTH_TIMEOUT_SECS)
-        _print_response_debug(resp)
-        return resp.status_code == 200
-    except requests.exceptions.RequestException as e:
-        print(f"Health request failed: {type(e).__name__}: {e}")
+        async with _stream_with_retry(
+            client, "GET", f"{API_URL}/health", headers=HEADERS, timeout=HEALTH_TIMEOUT_SECS
+        ) as resp:
+            out.append(await _response_debug(resp))
+            return resp.status_code == 200
+    except httpx.HTTPError as e:
+        out.append(f"Health request failed: {type(e).__name__}: {e}")
         return False
+    finally:
+        print("\n".join(out))
 
 
-def test_query(question: str = "什么是 RAG？", top_k: int = 3) -> bool:
+async def test_query(client: httpx.AsyncClient, question: str = DEFAULT_QUESTION, top_k: int = 3) -> bool:
     """Test the query endpoint. / クエリエンドポイントのテスト"""
-    token = _get_token()
-    headers = _auth_headers(token)
     data = {"question": question, "top_k": top_k}
 
-    print(f"\n🔍 POST /query")
-    print(f"Question: {question}")
-    print("-" * 50)
+    out = ["\n🔍 POST /query", f"Question: {question}", "-" * 50]
 
     try:
-        resp = requests.post(f"{API_URL}/query", json=data, headers=headers, timeout=QUERY_TIMEOUT_SECS)
-
-        if resp.status_code != 200:
-            _print_response_debug(resp)
-            return False
-
-        # Expect JSON on 200
-        result = resp.json()
+        async with _stream_with_retry(
+            client, "POST", f"{API_URL}/query", json=data, headers=HEADERS, timeout=QUERY_TIMEOUT_SECS
+        ) as resp:
+            if resp.status_code != 200:
+                out.append(await _response_debug(resp))
+                return False
+
+            # Expect JSON on 200
+            result = orjson.loads(await resp.aread())
         answer = result.get("answer", "No answer")
         contexts = result.get("contexts", []) or []
 
-        print("✅ Success")
-        print(f"\n📝 Answer:\n{answer}")
+        out.append("✅ Success")
+        out.append(f"\n📝 Answer:\n{answer}")
 
-        print(f"\n📚 Contexts ({len(contexts)}):")
+        out.append(f"\n📚 Contexts ({len(contexts)}):")
         for i, ctx in enumerate(contexts, 1):
             source = ctx.get("source", "unknown")
             score = ctx.get("score", None)
             score_str = f"{score:.4f}" if isinstance(score, (int, float)) else str(score)
-            print(f"  {i}. [{source}] (score: {score_str})")
+            out.append(f"  {i}. [{source}] (score: {score_str})")
 
         return True
 
-    except requests.exceptions.ReadTimeout:
-        print(f"Query request timed out after {QUERY_TIMEOUT_SECS}s")
+    except httpx.TimeoutException:
+        out.append(f"Query request timed out after {QUERY_TIMEOUT_SECS}s")
         return False
-    except requests.exceptions.RequestException as e:
-        print(f"Query request failed: {type(e).__name__}: {e}")
+    except httpx.HTTPError as e:
+        out.append(f"Query request failed: {type(e).__name__}: {e}")
         return False
     except Exception as e:
-        print(f"Unexpected error: {type(e).__name__}: {e}")
+        out.append(f"Unexpected error: {type(e).__name__}: {e}")
         return False
+    finally:
+        print("\n".join(out))
+
+
+async def main(questions: list[str]) -> bool:
+    """Run the health probe and all queries concurrently. / ヘルスチェックと全クエリを並行実行"""
+    # One client: HTTP/2 multiplexes the concurrent probes over a single TLS connection
+    async with httpx.AsyncClient(http2=True) as client:
+        results = await asyncio.gather(test_health(client), *(test_query(client, q) for q in questions))
+    return all(results)
 
 
 if __name__ == "__main__":
@@ -127,14 +170,12 @@ if __name__ == "__main__":
     print("Testing Azure Container Apps RAG API")
     print("=" * 50)
 
-    token = _get_token()
-    if token:
+    if TOKEN:
         print("Auth: ✅ AZURE_ACCESS_TOKEN is set")
     else:
         print("Auth: ⚠️  AZURE_ACCESS_TOKEN is NOT set (health may 401; query will fail)")
 
-    ok_health = test_health()
-    ok_query = test_query()
+    ok = asyncio.run(main(sys.argv[1:] or [DEFAULT_QUESTION]))
 
     # Exit code helpful for CI
-    sys.exit(0 if (ok_health and ok_query) else 1)
+    sys.exit(0 if ok else 1)